@@ -0,0 +1,178 @@
+import stat
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from loguru import logger
+from sqlalchemy import Column, DateTime, Index, Integer, Unicode
+
+from flexget import db_schema
+from flexget.event import event
+
+logger = logger.bind(name='sftp.db')
+Base = db_schema.versioned_base('sftp_list_cache', 0)
+
+# attributes of a cached node, named like the paramiko SFTPAttributes they stand in for
+CachedAttributes = namedtuple('CachedAttributes', ['st_size', 'st_mode', 'st_mtime'])
+
+
+class SftpListCache(Base):
+    __tablename__ = 'sftp_list_cache'
+
+    id = Column(Integer, primary_key=True)
+    host = Column(Unicode, nullable=False)
+    port = Column(Integer, nullable=False)
+    # users may be allowed to see different things on the same host
+    username = Column(Unicode)
+    path = Column(Unicode, nullable=False)
+    parent = Column(Unicode)
+    mtime = Column(Integer)
+    size = Column(Integer)
+    st_mode = Column(Integer)
+    # when the node was last seen in a listing of its parent
+    last_seen = Column(DateTime, default=datetime.now)
+    # when the node's own listing was stored, only set for directories
+    listed = Column(DateTime)
+
+
+Index(
+    'sftp_list_cache_path',
+    SftpListCache.host,
+    SftpListCache.port,
+    SftpListCache.username,
+    SftpListCache.path,
+)
+Index(
+    'sftp_list_cache_parent',
+    SftpListCache.host,
+    SftpListCache.port,
+    SftpListCache.username,
+    SftpListCache.parent,
+)
+
+
+@event('manager.db_cleanup')
+def db_cleanup(manager, session):
+    # Remove nodes which haven't been listed for a week
+    result = (
+        session.query(SftpListCache)
+        .filter(SftpListCache.last_seen < datetime.now() - timedelta(days=7))
+        .delete()
+    )
+    if result:
+        logger.verbose('Removed {} nodes from the sftp_list cache.', result)
+
+
+def get_listing(session, host, port, username, path, mtime, ttl):
+    """
+    Get the cached listing of a remote directory as (path, attributes) tuples sorted by name. The
+    directory and its children count as seen when the listing is used, so that they outlive
+    db_cleanup for as long as the listing is valid.
+
+    :param path: Absolute path of the directory
+    :param mtime: Current modification time of the directory
+    :param ttl: Maximum age of the listing, in seconds
+    :return: The listing, or None if the directory changed or the listing is too old
+    """
+    directory = (
+        session.query(SftpListCache)
+        .filter(SftpListCache.host == host)
+        .filter(SftpListCache.port == port)
+        .filter(SftpListCache.username == username)
+        .filter(SftpListCache.path == path)
+        .first()
+    )
+    if not directory or not directory.listed or directory.mtime != mtime:
+        return None
+    if directory.listed < datetime.now() - timedelta(seconds=ttl):
+        return None
+
+    now = datetime.now()
+    children = (
+        session.query(SftpListCache)
+        .filter(SftpListCache.host == host)
+        .filter(SftpListCache.port == port)
+        .filter(SftpListCache.username == username)
+        .filter(SftpListCache.parent == path)
+    )
+    children.update({'last_seen': now}, synchronize_session=False)
+    directory.last_seen = now
+    children = children.order_by(SftpListCache.path).all()
+    logger.debug('Using cached listing of {}', path)
+    return [
+        (child.path, CachedAttributes(child.size, child.st_mode, child.mtime))
+        for child in children
+    ]
+
+
+def store_listing(session, host, port, username, path, attr, nodes):
+    """
+    Replace the cached listing of a remote directory. Children which are still present keep their
+    own listings, so that unchanged subdirectories aren't listed again. Children which are gone are
+    dropped along with everything below them.
+
+    :param path: Absolute path of the directory
+    :param attr: Attributes of the directory
+    :param nodes: Listing of the directory as (absolute path, attributes) tuples
+    """
+    now = datetime.now()
+    query = (
+        session.query(SftpListCache)
+        .filter(SftpListCache.host == host)
+        .filter(SftpListCache.port == port)
+        .filter(SftpListCache.username == username)
+    )
+
+    directory = query.filter(SftpListCache.path == path).first()
+    if not directory:
+        directory = SftpListCache(host=host, port=port, username=username, path=path)
+        session.add(directory)
+    directory.mtime = attr.st_mtime
+    directory.size = attr.st_size
+    directory.st_mode = attr.st_mode
+    directory.last_seen = now
+    directory.listed = now
+
+    existing = {child.path: child for child in query.filter(SftpListCache.parent == path)}
+
+    for node, node_attr in nodes:
+        child = existing.pop(node, None)
+        if not child:
+            session.add(
+                SftpListCache(
+                    host=host,
+                    port=port,
+                    username=username,
+                    path=node,
+                    parent=path,
+                    mtime=node_attr.st_mtime,
+                    size=node_attr.st_size,
+                    st_mode=node_attr.st_mode,
+                    last_seen=now,
+                )
+            )
+            continue
+
+        if child.listed and not stat.S_ISDIR(node_attr.st_mode):
+            # a directory was replaced by something else
+            _delete_below(query, node)
+            child.listed = None
+        if not child.listed:
+            # the mtime of a listed directory tells whether its listing is still valid, so it's
+            # only updated when the directory is listed again
+            child.mtime = node_attr.st_mtime
+        child.size = node_attr.st_size
+        child.st_mode = node_attr.st_mode
+        child.last_seen = now
+
+    for node, child in existing.items():
+        _delete_below(query, node)
+        session.delete(child)
+
+
+def _delete_below(query, path):
+    """
+    Delete the cached nodes below a directory
+    """
+    query.filter(SftpListCache.path.startswith(path.rstrip('/') + '/', autoescape=True)).delete(
+        synchronize_session=False
+    )
@@ -1,100 +1,482 @@
+import asyncio
+import errno
+import inspect
 import logging
 import os
 import posixpath
+import random
+import stat
+import threading
 import time
-from collections import namedtuple
-from functools import partial
-from itertools import groupby
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from queue import Queue
 from urllib.parse import quote, unquote, urljoin, urlparse
 
+from jinja2 import Template, TemplateSyntaxError, meta
 from loguru import logger
 
 from flexget import plugin
 from flexget.config_schema import one_or_more
 from flexget.entry import Entry
 from flexget.event import event
+from flexget.manager import Session
 from flexget.utils.template import RenderError, render_from_entry
 
+from . import db
+
 logger = logger.bind(name='sftp')
 
 ConnectionConfig = namedtuple(
     'ConnectionConfig', ['host', 'port', 'username', 'password', 'private_key', 'private_key_pass']
 )
 
-# retry configuration constants
-CONNECT_TRIES = 3
-RETRY_INTERVAL = 15
-RETRY_STEP = 5
+# retry configuration constants, retries back off exponentially with full jitter
+CONNECT_TRIES = 5
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 60
 SOCKET_TIMEOUT = 15
 
+# size of the chunks copied between remote and local files
+TRANSFER_CHUNK_SIZE = 1 << 20
+
+# pooled connections left idle for longer than this many seconds are closed
+POOL_IDLE_TIMEOUT = 60
+
+# directory sizes are computed over parallel channels when listing more directories than this
+PARALLEL_DIR_SIZE_THRESHOLD = 4
+
+# outstanding directory listings and concurrent file transfers for the asyncssh backend
+ASYNCSSH_MAX_PENDING = 128
+ASYNCSSH_MAX_FILES = 16
+
+# upper bound for parallel connections to a single host, sshd's MaxSessions defaults to 10
+MAX_CONCURRENCY = 8
+
+# handshakes in progress to a single host. sshd starts dropping unauthenticated connections
+# beyond MaxStartups, which defaults to 10.
+MAX_PARALLEL_HANDSHAKES = 8
+
 # make separate path instances for local vs remote path styles
 localpath = os.path
 remotepath = posixpath  # pysftp uses POSIX style paths
 
 try:
+    import paramiko
     import pysftp
 
     logging.getLogger("paramiko").setLevel(logging.ERROR)
 except ImportError:
+    paramiko = None
     pysftp = None
 
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+# paramiko < 3.3 cannot bound the number of outstanding prefetch requests
+BOUNDED_PREFETCH = (
+    paramiko is not None
+    and 'max_concurrent_requests' in inspect.signature(paramiko.SFTPFile.prefetch).parameters
+)
+
+# idle connections shared by all sftp plugins, keyed by ConnectionConfig. Each value is a list of
+# (connection, release time) tuples with the most recently released connection last.
+_pool = {}
+_pool_lock = threading.Lock()
+_pool_timer = None
+
+# per-host semaphores limiting concurrent handshakes across all tasks
+_handshake_sems = {}
+_handshake_lock = threading.Lock()
+
+
+def _handshake_sem(host):
+    """
+    Get the semaphore limiting concurrent handshakes to host
+    """
+    with _handshake_lock:
+        return _handshake_sems.setdefault(host, threading.Semaphore(MAX_PARALLEL_HANDSHAKES))
+
 
 def sftp_connect(conf):
     """
     Helper function to connect to an sftp server
     """
     sftp = None
-    tries = CONNECT_TRIES
-    retry_interval = RETRY_INTERVAL
+    attempt = 0
 
     while not sftp:
         try:
-            sftp = pysftp.Connection(
-                host=conf.host,
-                username=conf.username,
-                private_key=conf.private_key,
-                password=conf.password,
-                port=conf.port,
-                private_key_pass=conf.private_key_pass,
-            )
+            # queue up rather than have the server drop the connection and retry after a delay
+            with _handshake_sem(conf.host):
+                sftp = pysftp.Connection(
+                    host=conf.host,
+                    username=conf.username,
+                    private_key=conf.private_key,
+                    password=conf.password,
+                    port=conf.port,
+                    private_key_pass=conf.private_key_pass,
+                )
             sftp.timeout = SOCKET_TIMEOUT
             logger.verbose('Connected to {}', conf.host)
         except Exception as e:
-            if not tries:
+            attempt += 1
+            if attempt >= CONNECT_TRIES:
                 raise e
             else:
+                retry_interval = random.uniform(
+                    0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+                )
                 logger.debug('Caught exception: {}', e)
                 logger.warning(
-                    'Failed to connect to {}; waiting {} seconds before retrying.',
+                    'Failed to connect to {}; waiting {:.1f} seconds before retrying.',
                     conf.host,
                     retry_interval,
                 )
                 time.sleep(retry_interval)
-                tries -= 1
-                retry_interval += RETRY_STEP
 
     return sftp
 
 
-def sftp_from_config(config):
+def sftp_listdir_attr(client, path):
     """
-    Creates an SFTP connection from a Flexget config object
+    List a remote directory as (path, attributes) tuples sorted by name, using a paramiko
+    SFTPClient. Symlinks are resolved so that nodes are classified the same way pysftp's walktree
+    does.
     """
-    host = config['host']
-    port = config['port']
-    username = config['username']
-    password = config['password']
-    private_key = config['private_key']
-    private_key_pass = config['private_key_pass']
+    nodes = []
+    for attr in sorted(client.listdir_attr(path), key=lambda a: a.filename):
+        node = remotepath.join(path, attr.filename)
+        if stat.S_ISLNK(attr.st_mode):
+            try:
+                attr = client.stat(node)
+            except IOError as e:
+                logger.debug('Failed to resolve symlink {} ({})', node, e)
+        nodes.append((node, attr))
+
+    return nodes
+
 
-    conn_conf = ConnectionConfig(host, port, username, password, private_key, private_key_pass)
+def sftp_dir_sizes(sftp, paths, channels):
+    """
+    Get the total size of several remote directories. Their subtrees are listed in parallel over
+    extra SFTP channels opened on the connection's SSH transport, which saves authenticating
+    again. Returns the sizes in the order of paths, -1 for directories that couldn't be walked.
+    """
+    transport = sftp.sftp_client.get_channel().get_transport()
+    clients = []
+    try:
+        for _ in range(min(channels, len(paths))):
+            clients.append(paramiko.SFTPClient.from_transport(transport))
+    except paramiko.SSHException as e:
+        # the server limits the number of sessions per connection (MaxSessions)
+        logger.debug('Could only open {} extra channel(s) ({})', len(clients), e)
+
+    sizes = [0] * len(paths)
+    failed = set()
+    lock = threading.Lock()
+    pending = Queue()
+    for index, path in enumerate(paths):
+        pending.put((index, path))
+
+    def worker(client):
+        while True:
+            item = pending.get()
+            if item is None:
+                pending.task_done()
+                return
 
+            index, path = item
+            try:
+                if index not in failed:
+                    nodes = sftp_listdir_attr(client, path)
+                    with lock:
+                        sizes[index] += sum(attr.st_size for _, attr in nodes)
+                    for node, attr in nodes:
+                        if stat.S_ISDIR(attr.st_mode):
+                            pending.put((index, node))
+            except Exception as e:
+                with lock:
+                    if index not in failed:
+                        logger.error('Failed to get size for {} ({})', paths[index], e)
+                        failed.add(index)
+            finally:
+                pending.task_done()
+
+    workers = clients or [sftp.sftp_client]
     try:
-        sftp = sftp_connect(conn_conf)
+        with ThreadPoolExecutor(max_workers=len(workers)) as executor:
+            for client in workers:
+                executor.submit(worker, client)
+            # wait for the whole subtrees to be listed, then stop the workers
+            pending.join()
+            for _ in workers:
+                pending.put(None)
+    finally:
+        for client in clients:
+            client.close()
+
+    return [-1 if index in failed else size for index, size in enumerate(sizes)]
+
+
+def sftp_get(sftp, path, destination, max_requests, size=None):
+    """
+    Download path to destination, keeping up to max_requests reads in flight. The size of the
+    remote file is looked up unless given.
+    """
+    with sftp.sftp_client.open(path, 'rb') as remote_file:
+        if size is None:
+            size = remote_file.stat().st_size
+        if BOUNDED_PREFETCH:
+            remote_file.prefetch(size, max_requests)
+        else:
+            remote_file.prefetch(size)
+
+        with open(destination, 'wb') as local_file:
+            for chunk in iter(partial(remote_file.read, TRANSFER_CHUNK_SIZE), b''):
+                local_file.write(chunk)
+
+
+def local_destination(path, dest, known_dirs):
+    """
+    Map a remote path, relative to the parent of the entry being downloaded, to its destination
+    below dest and create the local directories leading to it. known_dirs is the set of local
+    directories already created for the entry, so each is only checked once. Returns None if the
+    destination already exists.
+    """
+    # convert remote path style to local style
+    dest_relpath = path.lstrip(remotepath.sep).replace(remotepath.sep, localpath.sep)
+    destination = localpath.join(dest, dest_relpath)
+    dest_dir = localpath.dirname(destination)
+
+    if localpath.lexists(destination):
+        logger.verbose('Destination file already exists. Skipping {}', path)
+        return None
+
+    if dest_dir not in known_dirs:
+        os.makedirs(dest_dir, exist_ok=True)
+        known_dirs.add(dest_dir)
+
+    return destination
+
+
+@contextmanager
+def remove_partial(path, destination):
+    """
+    Remove the partially downloaded destination if downloading path to it fails
+    """
+    try:
+        yield
     except Exception as e:
-        raise plugin.PluginError('Failed to connect to %s (%s)' % (host, e))
+        logger.error('Failed to download {} ({})', path, e)
+        if localpath.exists(destination):
+            logger.debug('Removing partially downloaded file {}', destination)
+            os.remove(destination)
+        raise
 
-    return sftp
+
+def sftp_makedirs(sftp, path):
+    """
+    Create a remote directory and its parents. Unlike pysftp's makedirs, directories created by
+    another connection in the meantime are not an error.
+    """
+    if sftp.isdir(path):
+        return
+
+    parent = remotepath.dirname(path)
+    if parent and parent != path:
+        sftp_makedirs(sftp, parent)
+
+    try:
+        sftp.mkdir(path)
+    except IOError:
+        if not sftp.isdir(path):
+            raise
+
+
+def close_connection(sftp):
+    """
+    Close a connection, ignoring any errors
+    """
+    try:
+        sftp.close()
+    except Exception as e:
+        logger.debug('Caught exception while closing connection: {}', e)
+
+
+def pool_acquire(conf):
+    """
+    Check out a connection from the pool, connecting if there is no live idle connection
+    """
+    while True:
+        with _pool_lock:
+            idle = _pool.get(conf)
+            if not idle:
+                break
+            sftp, _ = idle.pop()
+
+        # REALPATH is a single cheap round-trip, enough to tell whether the connection is alive
+        try:
+            sftp.normalize('.')
+        except (EOFError, OSError, paramiko.SSHException) as e:
+            logger.debug('Discarding dead connection to {} ({})', conf.host, e)
+            close_connection(sftp)
+            continue
+
+        logger.debug('Reusing connection to {}', conf.host)
+        return sftp
+
+    return sftp_connect(conf)
+
+
+def pool_release(conf, sftp):
+    """
+    Return a connection to the pool so that it can be reused
+    """
+    # reset the working directory so the next user starts from the login directory
+    sftp.chdir(None)
+
+    with _pool_lock:
+        _pool.setdefault(conf, []).append((sftp, time.time()))
+        _schedule_eviction()
+
+
+def _schedule_eviction():
+    """
+    Start the idle connection eviction timer unless it's running. Call while holding _pool_lock.
+    """
+    global _pool_timer
+
+    if _pool_timer is None:
+        _pool_timer = threading.Timer(POOL_IDLE_TIMEOUT, _evict_idle)
+        _pool_timer.daemon = True
+        _pool_timer.start()
+
+
+def _evict_idle():
+    """
+    Close connections which have been idle for longer than POOL_IDLE_TIMEOUT
+    """
+    global _pool_timer
+
+    expired = []
+    cutoff = time.time() - POOL_IDLE_TIMEOUT
+
+    with _pool_lock:
+        _pool_timer = None
+        for conf, idle in list(_pool.items()):
+            expired.extend(sftp for sftp, released in idle if released <= cutoff)
+            idle[:] = [(sftp, released) for sftp, released in idle if released > cutoff]
+            if not idle:
+                del _pool[conf]
+        if _pool:
+            _schedule_eviction()
+
+    for sftp in expired:
+        close_connection(sftp)
+
+
+@event('manager.shutdown')
+def close_pool(manager):
+    """
+    Close all idle pooled connections
+    """
+    with _pool_lock:
+        idle = [sftp for connections in _pool.values() for sftp, _ in connections]
+        _pool.clear()
+
+    for sftp in idle:
+        close_connection(sftp)
+
+
+def connection_config(config):
+    """
+    Creates a hashable ConnectionConfig from a Flexget config object
+    """
+    return ConnectionConfig(
+        config['host'],
+        config['port'],
+        config['username'],
+        config['password'],
+        config['private_key'],
+        config['private_key_pass'],
+    )
+
+
+@contextmanager
+def sftp_from_config(config):
+    """
+    Checks out a pooled SFTP connection for a Flexget config object
+    """
+    conn_conf = connection_config(config)
+
+    try:
+        sftp = pool_acquire(conn_conf)
+    except Exception as e:
+        raise plugin.PluginError('Failed to connect to %s (%s)' % (conn_conf.host, e))
+
+    try:
+        yield sftp
+    finally:
+        pool_release(conn_conf, sftp)
+
+
+def pool_map(conf, func, items, concurrency, sftp=None, prepare=None):
+    """
+    Call func(connection, item) for each item and return the results in order, spreading the items
+    over up to concurrency pooled connections with a worker thread each. paramiko's SFTPClient is
+    not thread safe, so every worker has its own connection. sftp is a connection the caller
+    already checked out, the others are only checked out when there are enough items and set up
+    with prepare(connection). With a single connection the items are handled in the calling
+    thread.
+    """
+    if not items:
+        return []
+
+    connections = [sftp] if sftp else []
+    try:
+        try:
+            while len(connections) < min(concurrency, len(items)):
+                connection = pool_acquire(conf)
+                try:
+                    if prepare:
+                        prepare(connection)
+                except Exception:
+                    pool_release(conf, connection)
+                    raise
+                connections.append(connection)
+        except Exception as e:
+            if not connections:
+                raise plugin.PluginError('Failed to connect to %s (%s)' % (conf.host, e))
+            logger.warning(
+                'Could only open {} connection(s) to {} ({})', len(connections), conf.host, e
+            )
+
+        if len(connections) == 1:
+            return [func(connections[0], item) for item in items]
+
+        idle = Queue()
+        for connection in connections:
+            idle.put(connection)
+
+        def run(item):
+            connection = idle.get()
+            try:
+                return func(connection, item)
+            finally:
+                idle.put(connection)
+
+        with ThreadPoolExecutor(max_workers=len(connections)) as executor:
+            # consuming the results raises the first failure
+            return list(executor.map(run, items))
+    finally:
+        for connection in connections:
+            if connection is not sftp:
+                pool_release(conf, connection)
 
 
 def sftp_prefix(config):
@@ -115,11 +497,56 @@ def sftp_prefix(config):
     return 'sftp://%s%s%s/' % (login_str, config['host'], port_str)
 
 
-def dependency_check():
+def compile_path(path):
+    """
+    Compile a path template once for all entries. Paths which don't refer to any variables are
+    rendered right away and returned as a string.
+    """
+    from flexget.utils.template import environment
+
+    if not path:
+        return path
+
+    try:
+        ast = environment.parse(path)
+        template = environment.from_string(ast)
+        if meta.find_undeclared_variables(ast):
+            return template
+        return template.render()
+    except TemplateSyntaxError as e:
+        raise plugin.PluginError('Invalid jinja template as path: %s (%s)' % (path, e))
+    except Exception as e:
+        raise plugin.PluginError('Could not render path: %s (%s)' % (path, e))
+
+
+@lru_cache(maxsize=4096)
+def quote_component(component):
     """
-    Check if pysftp module is present
+    URL quote a single path component. Sibling nodes share most of their components, so these
+    are cached.
     """
-    if not pysftp:
+    return quote(component)
+
+
+def quote_path(path):
+    """
+    URL quote a remote path
+    """
+    return remotepath.sep.join(map(quote_component, path.split(remotepath.sep)))
+
+
+def dependency_check(backend='pysftp'):
+    """
+    Check if the module used by the backend is present
+    """
+    if backend == 'asyncssh':
+        if not asyncssh:
+            raise plugin.DependencyError(
+                issued_by='sftp',
+                missing='asyncssh',
+                message='sftp asyncssh backend requires the asyncssh Python module.',
+            )
+    elif not pysftp:
         raise plugin.DependencyError(
             issued_by='sftp',
             missing='pysftp',
@@ -127,6 +554,122 @@ def dependency_check():
         )
 
 
+def asyncssh_run(coro):
+    """
+    Run a coroutine to completion on a new event loop
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def asyncssh_connect(conf):
+    """
+    Connect to an sftp server with asyncssh. The result can be awaited or used as an async
+    context manager.
+    """
+    kwargs = {}
+    if conf.private_key:
+        kwargs['client_keys'] = [conf.private_key]
+        kwargs['passphrase'] = conf.private_key_pass
+
+    return asyncssh.connect(
+        conf.host, port=conf.port, username=conf.username, password=conf.password, **kwargs
+    )
+
+
+async def asyncssh_walk(sftp, path, recursive, get_size, files_only, semaphore):
+    """
+    Walk a remote directory with asyncssh, listing subdirectories concurrently. Returns the nodes
+    below path as (path, size, is_dir) tuples, and the total size of the directory. Directory
+    sizes are only known when recursing or if get_size is set and directories aren't omitted,
+    subdirectories are then walked just to get their size. Subdirectories which can't be listed
+    are logged and have a size of -1, as do the directories containing them.
+    """
+    async with semaphore:
+        names = await sftp.readdir(path)
+
+    nodes = []
+    subdirs = []
+    total = 0
+    failed = False
+
+    for name in sorted(names, key=lambda n: n.filename):
+        if name.filename in ('.', '..'):
+            continue
+
+        node = remotepath.join(path, name.filename)
+        attrs = name.attrs
+        if stat.S_ISLNK(attrs.permissions or 0):
+            try:
+                attrs = await sftp.stat(node)
+            except asyncssh.SFTPError as e:
+                logger.debug('Failed to resolve symlink {} ({})', node, e)
+
+        mode = attrs.permissions or 0
+        total += attrs.size or 0
+        if stat.S_ISDIR(mode):
+            subdirs.append(node)
+        elif stat.S_ISREG(mode):
+            nodes.append((node, attrs.size, False))
+        else:
+            logger.warning('Skipping unknown file: {}', node)
+
+    if recursive or (get_size and not files_only):
+        # let every listing finish before raising, so that no task is left pending
+        results = await asyncio.gather(
+            *(
+                asyncssh_walk(sftp, node, True, get_size, files_only, semaphore)
+                for node in subdirs
+            ),
+            return_exceptions=True,
+        )
+        for node, result in zip(subdirs, results):
+            if isinstance(result, (OSError, asyncssh.SFTPError)):
+                logger.error('Failed to open {} ({})', node, result)
+            elif isinstance(result, Exception):
+                raise result
+    else:
+        results = [([], None)] * len(subdirs)
+
+    for node, result in zip(subdirs, results):
+        children, size = ([], -1) if isinstance(result, Exception) else result
+        if recursive:
+            nodes.extend(children)
+        nodes.append((node, size, True))
+        if size == -1:
+            failed = True
+        else:
+            total += size or 0
+
+    return nodes, -1 if failed else total
+
+
+async def asyncssh_list(conf, dirs, recursive, get_size, files_only):
+    """
+    List remote directories with asyncssh. Returns the login directory and the nodes found as
+    (path, size, is_dir) tuples.
+    """
+    semaphore = asyncio.Semaphore(ASYNCSSH_MAX_PENDING)
+    nodes = []
+
+    async with asyncssh_connect(conf) as conn, conn.start_sftp_client() as sftp:
+        base = await sftp.realpath('.')
+        for dir in dirs:
+            try:
+                dir_nodes, _ = await asyncssh_walk(
+                    sftp, dir, recursive, get_size, files_only, semaphore
+                )
+            except (OSError, asyncssh.SFTPError) as e:
+                logger.error('Failed to open {} ({})', dir, e)
+                continue
+            nodes.extend(dir_nodes)
+
+    return base, nodes
+
+
 class SftpList:
     """
     Generate entries from SFTP. This plugin requires the pysftp Python module and its dependencies.
@@ -144,6 +687,13 @@ class SftpList:
                           WARNING: This can be very slow when computing the size of directories!
     files_only:           Indicates wheter to omit diredtories from the results.
     dirs:                 List of directories to download
+    backend:              Either pysftp (default) or asyncssh, which lists subdirectories
+                          concurrently. asyncssh requires the asyncssh Python module.
+    cache:                Indicates whether to keep listings in the database and reuse those of
+                          directories which haven't been modified since. pysftp backend only.
+    cache_ttl:            Number of seconds after which cached listings are refreshed anyway,
+                          defaults to 3600. A directory's modification time only changes with its
+                          own children, so this bounds how stale file sizes can get.
 
     Example:
 
@@ -172,6 +722,9 @@ class SftpList:
             'private_key': {'type': 'string'},
             'private_key_pass': {'type': 'string'},
             'dirs': one_or_more({'type': 'string'}),
+            'backend': {'type': 'string', 'enum': ['pysftp', 'asyncssh'], 'default': 'pysftp'},
+            'cache': {'type': 'boolean', 'default': False},
+            'cache_ttl': {'type': 'integer', 'default': 3600, 'minimum': 0},
         },
         'additionProperties': False,
         'required': ['host', 'username'],
@@ -194,76 +747,109 @@ class SftpList:
         Input task handler
         """
 
-        dependency_check()
-
         config = self.prepare_config(config)
 
+        dependency_check(config['backend'])
+
         files_only = config['files_only']
         recursive = config['recursive']
         get_size = config['get_size']
-        private_key = config['private_key']
-        private_key_pass = config['private_key_pass']
         dirs = config['dirs']
         if not isinstance(dirs, list):
             dirs = [dirs]
 
-        logger.debug('Connecting to {}', config['host'])
-
-        sftp = sftp_from_config(config)
-        url_prefix = sftp_prefix(config)
+        url_base = sftp_prefix(config).rstrip('/')
 
-        entries = []
+        # fields shared by every entry, so that sftp_download can log in the same way
+        base_fields = {}
+        if config['private_key']:
+            base_fields['private_key'] = config['private_key']
+            if config['private_key_pass']:
+                base_fields['private_key_pass'] = config['private_key_pass']
 
-        def file_size(path):
+        def listdir(path, attr):
             """
-            Helper function to get the size of a node
+            List a directory, reusing its cached listing if it hasn't been modified since. attr are
+            the current attributes of the directory, if known. Returns the listing and whether it
+            is fresh.
             """
-            return sftp.lstat(path).st_size
+            if not config['cache']:
+                return sftp_listdir_attr(sftp.sftp_client, path), True
+
+            if attr is None:
+                attr = sftp.sftp_client.stat(path)
+
+            host, port, username = config['host'], config['port'], config['username']
+            abs_path = remotepath.normpath(remotepath.join(base, path))
+            # each directory gets its own short transaction, so that the database isn't locked
+            # while the remote side is being listed
+            with Session() as session:
+                cached = db.get_listing(
+                    session, host, port, username, abs_path, attr.st_mtime, config['cache_ttl']
+                )
+            if cached is not None:
+                return [
+                    (remotepath.join(path, remotepath.basename(node)), node_attr)
+                    for node, node_attr in cached
+                ], False
+
+            nodes = sftp_listdir_attr(sftp.sftp_client, path)
+            abs_nodes = [
+                (remotepath.join(abs_path, remotepath.basename(node)), node_attr)
+                for node, node_attr in nodes
+            ]
+            with Session() as session:
+                db.store_listing(session, host, port, username, abs_path, attr, abs_nodes)
+            return nodes, True
 
         def dir_size(path):
             """
             Walk a directory to get its size
             """
-            sizes = []
+            size = 0
+            for node, attr in sftp_listdir_attr(sftp.sftp_client, path):
+                size += attr.st_size
+                if stat.S_ISDIR(attr.st_mode):
+                    size += dir_size(node)
 
-            def node_size(f):
-                sizes.append(file_size(f))
+            return size
 
-            sftp.walktree(path, node_size, node_size, node_size, True)
-            size = sum(sizes)
+        def dir_sizes(paths):
+            """
+            Get the sizes of several directories, walking them in parallel if there are enough
+            """
+            if len(paths) > PARALLEL_DIR_SIZE_THRESHOLD:
+                return sftp_dir_sizes(sftp, paths, MAX_CONCURRENCY)
 
-            return size
+            sizes = []
+            for path in paths:
+                try:
+                    sizes.append(dir_size(path))
+                except Exception as e:
+                    logger.error('Failed to get size for {} ({})', path, e)
+                    sizes.append(-1)
+
+            return sizes
 
-        def handle_node(path, size_handler, is_dir):
+        def handle_node(path, size, is_dir):
             """
-            Generic helper function for handling a remote file system node
+            Generic helper function for handling a remote file system node, yielding its entry
             """
             if is_dir and files_only:
                 return
 
-            url = urljoin(url_prefix, quote(sftp.normalize(path)))
+            # resolve the path locally rather than with a REALPATH round-trip per node. It's
+            # absolute, so it can be appended to the prefix instead of going through urljoin.
+            url = url_base + quote_path(remotepath.normpath(remotepath.join(base, path)))
             title = remotepath.basename(path)
 
             entry = Entry(title, url)
+            entry.update(base_fields)
 
             if get_size:
-                try:
-                    size = size_handler(path)
-                except Exception as e:
-                    logger.error('Failed to get size for {} ({})', path, e)
-                    size = -1
                 entry['content_size'] = size
 
-            if private_key:
-                entry['private_key'] = private_key
-                if private_key_pass:
-                    entry['private_key_pass'] = private_key_pass
-
-            entries.append(entry)
-
-        # create helper functions to handle files and directories
-        handle_file = partial(handle_node, size_handler=file_size, is_dir=False)
-        handle_dir = partial(handle_node, size_handler=dir_size, is_dir=True)
+            yield entry
 
         def handle_unknown(path):
             """
@@ -271,15 +857,82 @@ class SftpList:
             """
             logger.warning('Skipping unknown file: {}', path)
 
-        # the business end
-        for dir in dirs:
+        def walk(path):
+            """
+            Walk a directory depth first yielding entries, reusing the attributes returned by the
+            listing. Directory sizes are summed bottom-up while recursing so that no subtree is
+            walked twice.
+            """
+            subtree_size = {path: 0}
+            # (directory, attributes, parent, listed) tuples; directories are handled after all of
+            # their children. Attributes are None unless they come from a fresh listing.
+            stack = [(path, None, None, False)]
+
+            while stack:
+                dir_path, dir_attr, parent, listed = stack.pop()
+
+                if listed:
+                    size = subtree_size.pop(dir_path)
+                    if parent is not None:
+                        subtree_size[parent] += size
+                        yield from handle_node(dir_path, size, is_dir=True)
+                    continue
+
+                stack.append((dir_path, dir_attr, parent, True))
+                subdirs = []
+
+                nodes, fresh = listdir(dir_path, dir_attr)
+                for node, attr in nodes:
+                    subtree_size[dir_path] += attr.st_size
+                    if stat.S_ISDIR(attr.st_mode):
+                        if recursive:
+                            subtree_size[node] = 0
+                        subdirs.append((node, attr if fresh else None, dir_path, False))
+                    elif stat.S_ISREG(attr.st_mode):
+                        yield from handle_node(node, attr.st_size, is_dir=False)
+                    else:
+                        handle_unknown(node)
+
+                if recursive:
+                    # reversed, so that subdirectories are walked in name order
+                    stack.extend(reversed(subdirs))
+                elif subdirs and not files_only:
+                    if get_size:
+                        sizes = dir_sizes([node for node, _, _, _ in subdirs])
+                    else:
+                        sizes = [None] * len(subdirs)
+                    for (node, _, _, _), size in zip(subdirs, sizes):
+                        yield from handle_node(node, size, is_dir=True)
+
+        logger.debug('Connecting to {}', config['host'])
+
+        if config['backend'] == 'asyncssh':
+            if config['cache']:
+                logger.warning('The asyncssh backend does not support the cache, not using it')
+
+            conn_conf = connection_config(config)
             try:
-                sftp.walktree(dir, handle_file, handle_dir, handle_unknown, recursive)
-            except IOError as e:
-                logger.error('Failed to open {} ({})', dir, e)
-                continue
+                base, nodes = asyncssh_run(
+                    asyncssh_list(conn_conf, dirs, recursive, get_size, files_only)
+                )
+            except (OSError, asyncssh.Error) as e:
+                raise plugin.PluginError('Failed to connect to %s (%s)' % (conn_conf.host, e))
 
-        sftp.close()
+            return [
+                entry for node, size, is_dir in nodes for entry in handle_node(node, size, is_dir)
+            ]
+
+        entries = []
+
+        # the business end
+        with sftp_from_config(config) as sftp:
+            base = sftp.normalize('.')
+            for dir in dirs:
+                try:
+                    entries.extend(walk(dir))
+                except IOError as e:
+                    logger.error('Failed to open {} ({})', dir, e)
+                    continue
 
         return entries
 
@@ -296,12 +949,19 @@ class SftpDownload:
                         metainfo_series or similar.
     recursive:          Indicates wether to download directory contents recursively.
     delete_origin:      Indicates wether to delete the remote files(s) once they've been downloaded.
+    concurrency:        Number of connections used to download the contents of a directory in
+                        parallel. Defaults to 1, at most 8.
+    max_unconfirmed_reads: Number of read requests to keep in flight while downloading a file.
+                        Defaults to 64, like the OpenSSH sftp client.
+    backend:            Either pysftp (default) or asyncssh, which transfers several files at once
+                        over a single connection. asyncssh requires the asyncssh Python module.
 
     Example:
 
       sftp_download:
           to: '/Volumes/External/Drobo/downloads'
           delete_origin: False
+          concurrency: 4
     """
 
     schema = {
@@ -310,6 +970,14 @@ class SftpDownload:
             'to': {'type': 'string', 'format': 'path'},
             'recursive': {'type': 'boolean', 'default': True},
             'delete_origin': {'type': 'boolean', 'default': False},
+            'concurrency': {
+                'type': 'integer',
+                'default': 1,
+                'minimum': 1,
+                'maximum': MAX_CONCURRENCY,
+            },
+            'max_unconfirmed_reads': {'type': 'integer', 'default': 64, 'minimum': 1},
+            'backend': {'type': 'string', 'enum': ['pysftp', 'asyncssh'], 'default': 'pysftp'},
         },
         'required': ['to'],
         'additionalProperties': False,
@@ -340,36 +1008,22 @@ class SftpDownload:
 
         return config
 
-    def download_file(self, path, dest, sftp, delete_origin):
+    def download_file(self, path, dest, sftp, config, known_dirs, size=None):
         """
-        Download a file from path to dest
+        Download a file from path to dest. known_dirs is the set of local directories already
+        created for the entry, so each is only checked once.
         """
         dir_name = remotepath.dirname(path)
-        dest_relpath = localpath.join(
-            *remotepath.split(path)
-        )  # convert remote path style to local style
-        destination = localpath.join(dest, dest_relpath)
-        dest_dir = localpath.dirname(destination)
-
-        if localpath.exists(destination):
-            logger.verbose('Destination file already exists. Skipping {}', path)
+        destination = local_destination(path, dest, known_dirs)
+        if destination is None:
             return
 
-        if not localpath.exists(dest_dir):
-            os.makedirs(dest_dir)
-
         logger.verbose('Downloading file {} to {}', path, destination)
 
-        try:
-            sftp.get(path, destination)
-        except Exception as e:
-            logger.error('Failed to download {} ({})', path, e)
-            if localpath.exists(destination):
-                logger.debug('Removing partially downloaded file {}', destination)
-                os.remove(destination)
-            raise e
+        with remove_partial(path, destination):
+            sftp_get(sftp, path, destination, config['max_unconfirmed_reads'], size)
 
-        if delete_origin:
+        if config['delete_origin']:
             logger.debug('Deleting remote file {}', path)
             try:
                 sftp.remove(path)
@@ -379,12 +1033,6 @@ class SftpDownload:
 
             self.remove_dir(sftp, dir_name)
 
-    def handle_dir(self, path):
-        """
-        Dummy directory handler. Does nothing.
-        """
-        pass
-
     def handle_unknown(self, path):
         """
         Dummy unknown file handler. Warns about unknown files.
@@ -395,57 +1043,98 @@ class SftpDownload:
         """
         Remove a directory if it's empty
         """
-        if sftp.exists(path) and not sftp.listdir(path):
-            logger.debug('Attempting to delete directory {}', path)
-            try:
-                sftp.rmdir(path)
-            except Exception as e:
+        # the server refuses to remove missing or non-empty directories, so there's no need to
+        # check first
+        logger.debug('Attempting to delete directory {}', path)
+        try:
+            sftp.rmdir(path)
+        except IOError as e:
+            # non-empty directories are usually refused with a generic failure, which paramiko
+            # raises without an errno
+            if e.errno in (None, errno.ENOENT, errno.ENOTEMPTY):
+                logger.debug('Not deleting directory {} ({})', path, e)
+            else:
                 logger.error('Failed to delete directory {} ({})', path, e)
+        except Exception as e:
+            logger.error('Failed to delete directory {} ({})', path, e)
 
-    def download_entry(self, entry, config, sftp):
+    def list_files(self, sftp, path, recursive):
         """
-        Downloads the file(s) described in entry
+        List the files in a remote directory as (path, size) tuples
+        """
+        files = []
+        for node, attr in sftp_listdir_attr(sftp.sftp_client, path):
+            if stat.S_ISDIR(attr.st_mode):
+                if recursive:
+                    files.extend(self.list_files(sftp, node, recursive))
+            elif stat.S_ISREG(attr.st_mode):
+                files.append((node, attr.st_size))
+            else:
+                self.handle_unknown(node)
+
+        return files
+
+    def download_files(self, files, base_path, dest, sftp_config, sftp, config, known_dirs):
+        """
+        Download (path, size) files relative to base_path to dest, over up to concurrency
+        connections. sftp must be in base_path already.
         """
 
+        def download(connection, file):
+            path, size = file
+            self.download_file(path, dest, connection, config, known_dirs, size)
+
+        pool_map(
+            sftp_config,
+            download,
+            files,
+            config['concurrency'],
+            sftp,
+            prepare=lambda connection: connection.cwd(base_path),
+        )
+
+    def download_entry(self, entry, to, config, sftp_config, sftp):
+        """
+        Downloads the file(s) described in entry
+        """
         path = unquote(urlparse(entry['url']).path) or '.'
         delete_origin = config['delete_origin']
         recursive = config['recursive']
+        known_dirs = set()
 
-        to = config['to']
-        if to:
+        if isinstance(to, Template):
             try:
                 to = render_from_entry(to, entry)
             except RenderError as e:
-                logger.error('Could not render path: {}', to)
+                logger.error('Could not render path: {}', config['to'])
                 entry.fail(e)
                 return
 
-        if not sftp.lexists(path):
+        # a single STAT tells whether the path exists and what it is
+        try:
+            attr = sftp.sftp_client.stat(path)
+        except IOError:
             logger.error('Remote path does not exist: {}', path)
             return
 
-        if sftp.isfile(path):
+        if stat.S_ISREG(attr.st_mode):
             source_file = remotepath.basename(path)
             source_dir = remotepath.dirname(path)
             try:
                 sftp.cwd(source_dir)
-                self.download_file(source_file, to, sftp, delete_origin)
+                self.download_file(source_file, to, sftp, config, known_dirs, attr.st_size)
             except Exception as e:
                 error = 'Failed to download file %s (%s)' % (path, e)
                 logger.error(error)
                 entry.fail(error)
-        elif sftp.isdir(path):
+        elif stat.S_ISDIR(attr.st_mode):
             base_path = remotepath.normpath(remotepath.join(path, '..'))
             dir_name = remotepath.basename(path)
-            handle_file = partial(
-                self.download_file, dest=to, sftp=sftp, delete_origin=delete_origin
-            )
 
             try:
                 sftp.cwd(base_path)
-                sftp.walktree(
-                    dir_name, handle_file, self.handle_dir, self.handle_unknown, recursive
-                )
+                files = self.list_files(sftp, dir_name, recursive)
+                self.download_files(files, base_path, to, sftp_config, sftp, config, known_dirs)
             except Exception as e:
                 error = 'Failed to download directory %s (%s)' % (path, e)
                 logger.error(error)
@@ -458,32 +1147,159 @@ class SftpDownload:
         else:
             logger.warning('Skipping unknown file {}', path)
 
+    async def download_entry_asyncssh(self, entry, to, config, sftp, semaphore):
+        """
+        Downloads the file(s) described in entry with asyncssh, several files at a time
+        """
+        path = unquote(urlparse(entry['url']).path) or '.'
+        delete_origin = config['delete_origin']
+
+        if isinstance(to, Template):
+            try:
+                to = render_from_entry(to, entry)
+            except RenderError as e:
+                logger.error('Could not render path: {}', config['to'])
+                entry.fail(e)
+                return
+
+        try:
+            attrs = await sftp.stat(path)
+        except asyncssh.SFTPError:
+            logger.error('Remote path does not exist: {}', path)
+            return
+
+        mode = attrs.permissions or 0
+        if stat.S_ISREG(mode):
+            files = [(path, attrs.size)]
+        elif stat.S_ISDIR(mode):
+            listing_semaphore = asyncio.Semaphore(ASYNCSSH_MAX_PENDING)
+            try:
+                nodes, size = await asyncssh_walk(
+                    sftp, path, config['recursive'], False, True, listing_semaphore
+                )
+            except (OSError, asyncssh.SFTPError) as e:
+                error = 'Failed to download directory %s (%s)' % (path, e)
+                logger.error(error)
+                entry.fail(error)
+                return
+            if size == -1:
+                # the subdirectories which couldn't be listed have been logged by the walk
+                error = 'Failed to download directory %s (not all of it could be listed)' % path
+                logger.error(error)
+                entry.fail(error)
+                return
+            files = [(node, size) for node, size, is_dir in nodes if not is_dir]
+        else:
+            logger.warning('Skipping unknown file {}', path)
+            return
+
+        known_dirs = set()
+        name = remotepath.basename(path)
+
+        async def download(node):
+            # relative to the entry's parent directory, like the paths of the pysftp backend
+            if node != path:
+                relpath = remotepath.join(name, remotepath.relpath(node, path))
+            else:
+                relpath = name
+            destination = local_destination(relpath, to, known_dirs)
+            if destination is None:
+                return
+
+            async with semaphore:
+                logger.verbose('Downloading file {} to {}', node, destination)
+                with remove_partial(node, destination):
+                    await sftp.get(node, destination, max_requests=config['max_unconfirmed_reads'])
+
+                if delete_origin:
+                    logger.debug('Deleting remote file {}', node)
+                    try:
+                        await sftp.remove(node)
+                    except asyncssh.SFTPError as e:
+                        logger.error('Failed to delete file {} ({})', node, e)
+
+        # let every transfer finish before failing the entry, so that no task is left pending
+        results = await asyncio.gather(
+            *(download(node) for node, _ in files), return_exceptions=True
+        )
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            error = 'Failed to download %s (%s)' % (path, errors[0])
+            logger.error(error)
+            entry.fail(error)
+            return
+
+        if delete_origin:
+            dirs = {remotepath.dirname(node) for node, _ in files}
+            if stat.S_ISDIR(mode):
+                dirs.add(path)
+            # deepest first, so that the entry's own directory is tried once it may be empty
+            for dir_path in sorted(dirs, key=lambda d: d.count(remotepath.sep), reverse=True):
+                try:
+                    await sftp.rmdir(dir_path)
+                except asyncssh.SFTPError as e:
+                    logger.debug('Not deleting directory {} ({})', dir_path, e)
+
+    async def download_entries_asyncssh(self, sftp_config, entries, to, config):
+        """
+        Downloads entries from a single host with asyncssh
+        """
+        try:
+            conn = await asyncssh_connect(sftp_config)
+        except (OSError, asyncssh.Error) as e:
+            error_message = 'Failed to connect to %s (%s)' % (sftp_config.host, e)
+            logger.error(error_message)
+            for entry in entries:
+                entry.fail(error_message)
+            return
+
+        semaphore = asyncio.Semaphore(ASYNCSSH_MAX_FILES)
+        async with conn, conn.start_sftp_client() as sftp:
+            for entry in entries:
+                await self.download_entry_asyncssh(entry, to, config, sftp, semaphore)
+
     def on_task_download(self, task, config):
         """
         Task handler for sftp_download plugin
         """
-        dependency_check()
+        dependency_check(config['backend'])
+
+        if config['backend'] == 'pysftp' and not BOUNDED_PREFETCH:
+            # max_unconfirmed_reads always has a value, so this is no reason to warn every run
+            logger.debug(
+                'max_unconfirmed_reads requires paramiko 3.3 or later, reads are not bounded'
+            )
+
+        to = compile_path(config['to'])
 
-        # Download entries by host so we can reuse the connection
-        for sftp_config, entries in groupby(task.accepted, self.get_sftp_config):
-            if not sftp_config:
+        # Download entries by host so we can reuse the connection. Entries for the same host are
+        # not necessarily adjacent, so group all of them up front.
+        entries_by_config = defaultdict(list)
+        for entry in task.accepted:
+            sftp_config = self.get_sftp_config(entry)
+            if sftp_config:
+                entries_by_config[sftp_config].append(entry)
+
+        for sftp_config, entries in entries_by_config.items():
+            if config['backend'] == 'asyncssh':
+                asyncssh_run(self.download_entries_asyncssh(sftp_config, entries, to, config))
                 continue
 
-            error_message = None
-            sftp = None
             try:
-                sftp = sftp_connect(sftp_config)
+                sftp = pool_acquire(sftp_config)
             except Exception as e:
                 error_message = 'Failed to connect to %s (%s)' % (sftp_config.host, e)
                 logger.error(error_message)
-
-            for entry in entries:
-                if sftp:
-                    self.download_entry(entry, config, sftp)
-                else:
+                for entry in entries:
                     entry.fail(error_message)
-            if sftp:
-                sftp.close()
+                continue
+
+            # extra connections for directories are checked out by download_files
+            try:
+                for entry in entries:
+                    self.download_entry(entry, to, config, sftp_config, sftp)
+            finally:
+                pool_release(sftp_config, sftp)
 
 
 class SftpUpload:
@@ -502,6 +1318,10 @@ class SftpUpload:
                           metainfo_series or similar.
     delete_origin:        Indicates wheter to delete the original file after a successful
                           upload.
+    confirm:              Indicates whether to check the size of the uploaded file afterwards. This
+                          costs an extra round-trip per file.
+    concurrency:          Number of connections used to upload files in parallel. Defaults to 1, at
+                          most 8.
 
     Example:
 
@@ -524,6 +1344,13 @@ class SftpUpload:
             'private_key_pass': {'type': 'string'},
             'to': {'type': 'string'},
             'delete_origin': {'type': 'boolean', 'default': False},
+            'confirm': {'type': 'boolean', 'default': False},
+            'concurrency': {
+                'type': 'integer',
+                'default': 1,
+                'minimum': 1,
+                'maximum': MAX_CONCURRENCY,
+            },
         },
         'additionProperties': False,
         'required': ['host', 'username'],
@@ -540,19 +1367,20 @@ class SftpUpload:
 
         return config
 
-    def handle_entry(self, entry, sftp, config, url_prefix):
-
+    def handle_entry(self, entry, sftp, to, config, url_prefix, dir_locks):
+        """
+        Upload the file described in entry. Entries are handled by worker threads, so rather than
+        failing the entry this returns the reason it failed, if any.
+        """
         location = entry['location']
         filename = localpath.basename(location)
 
-        to = config['to']
-        if to:
+        if isinstance(to, Template):
             try:
                 to = render_from_entry(to, entry)
             except RenderError as e:
-                logger.error('Could not render path: {}', to)
-                entry.fail(e)
-                return
+                logger.error('Could not render path: {}', config['to'])
+                return e
 
         destination = remotepath.join(to, filename)
         destination_url = urljoin(url_prefix, destination)
@@ -561,30 +1389,31 @@ class SftpUpload:
             logger.warning('File no longer exists: {}', location)
             return
 
-        if not sftp.lexists(to):
-            try:
-                sftp.makedirs(to)
-            except Exception as e:
-                logger.error('Failed to create remote directory {} ({})', to, e)
-                entry.fail(e)
-                return
+        # entries sharing a destination create it one at a time rather than all at once
+        with dir_locks.setdefault(to, threading.Lock()):
+            if not sftp.lexists(to):
+                try:
+                    sftp_makedirs(sftp, to)
+                except Exception as e:
+                    logger.error('Failed to create remote directory {} ({})', to, e)
+                    return e
 
-        if not sftp.isdir(to):
-            logger.error('Not a directory: {}', to)
-            entry.fail('Not a directory: %s' % to)
-            return
+            if not sftp.isdir(to):
+                logger.error('Not a directory: {}', to)
+                return 'Not a directory: %s' % to
 
         try:
-            sftp.put(localpath=location, remotepath=destination)
+            sftp.put(localpath=location, remotepath=destination, confirm=config['confirm'])
             logger.verbose('Successfully uploaded {} to {}', location, destination_url)
-        except IOError as e:
-            logger.error('Remote directory does not exist: {} ({})', to)
-            entry.fail('Remote directory does not exist: %s (%s)' % to)
-            return
         except Exception as e:
-            logger.error('Failed to upload {} ({})', location, e)
-            entry.fail('Failed to upload %s (%s)' % (location, e))
-            return
+            # paramiko reports missing remote paths with ENOENT, while a size mismatch found when
+            # confirming is an IOError without errno
+            if isinstance(e, IOError) and e.errno == errno.ENOENT:
+                error = 'Remote directory does not exist: %s (%s)' % (to, e)
+            else:
+                error = 'Failed to upload %s (%s)' % (location, e)
+            logger.error(error)
+            return error
 
         if config['delete_origin']:
             try:
@@ -595,18 +1424,26 @@ class SftpUpload:
     def on_task_output(self, task, config):
         """Uploads accepted entries to the specified SFTP server."""
 
+        entries = list(task.accepted)
+        if not entries:
+            return
+
         config = self.prepare_config(config)
 
-        sftp = sftp_from_config(config)
         url_prefix = sftp_prefix(config)
+        to = compile_path(config['to'])
+        dir_locks = {}
 
-        for entry in task.accepted:
-            if sftp:
-                logger.debug('Uploading file: {}', entry)
-                self.handle_entry(entry, sftp, config, url_prefix)
-            else:
-                logger.debug('SFTP connection failed; failing entry: {}', entry)
-                entry.fail('SFTP connection failed; failing entry: %s' % entry)
+        def upload(sftp, entry):
+            logger.debug('Uploading file: {}', entry)
+            return self.handle_entry(entry, sftp, to, config, url_prefix, dir_locks)
+
+        errors = pool_map(connection_config(config), upload, entries, config['concurrency'])
+
+        # fail entries from the task's thread, their fail hooks may use the database
+        for entry, error in zip(entries, errors):
+            if error:
+                entry.fail(error)
 
 
 @event('plugin.register')
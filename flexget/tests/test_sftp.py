@@ -0,0 +1,848 @@
+import asyncio
+import copy
+import errno
+import io
+import posixpath
+import stat
+import threading
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+from jinja2 import Template
+
+from flexget import plugin
+from flexget.components.ftp import db, sftp
+from flexget.entry import Entry
+from flexget.manager import Session
+from flexget.utils.template import render_from_entry
+
+DIR = stat.S_IFDIR | 0o755
+FILE = stat.S_IFREG | 0o644
+
+
+def attributes(mode, size=0, mtime=0, filename=None):
+    return SimpleNamespace(filename=filename, st_mode=mode, st_size=size, st_mtime=mtime)
+
+
+class FakeFile(io.BytesIO):
+    """Stands in for a paramiko SFTPFile opened for reading"""
+
+    def prefetch(self, size, max_requests=None):
+        pass
+
+    def stat(self):
+        return attributes(FILE, len(self.getvalue()))
+
+
+class FakeClient:
+    """
+    Stands in for a paramiko SFTPClient serving a tree of nested dicts, where files are given by
+    their size. Paths are relative to the root of the tree, or to cwd.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.listed = []
+        self.denied = set()
+        self.cwd = ''
+
+    def lookup(self, path):
+        node = self.tree
+        for part in posixpath.normpath(posixpath.join(self.cwd, path)).split('/'):
+            if part in ('', '.'):
+                continue
+            try:
+                node = node[part]
+            except (KeyError, TypeError):
+                raise IOError(errno.ENOENT, 'No such file')
+        return node
+
+    def attributes(self, node, filename=None):
+        if isinstance(node, dict):
+            return attributes(DIR, filename=filename)
+        return attributes(FILE, node, filename=filename)
+
+    def listdir_attr(self, path):
+        self.listed.append(path)
+        if path in self.denied:
+            raise IOError(errno.EACCES, 'Permission denied')
+        node = self.lookup(path)
+        return [self.attributes(child, name) for name, child in node.items()]
+
+    def stat(self, path):
+        return self.attributes(self.lookup(path))
+
+    def open(self, path, mode):
+        return FakeFile(b'x' * self.lookup(path))
+
+    def get_channel(self):
+        return mock.Mock()
+
+    def close(self):
+        pass
+
+
+class FakeSftp:
+    """Stands in for a pysftp Connection logged in at the root of the tree"""
+
+    def __init__(self, tree):
+        self.sftp_client = FakeClient(tree)
+
+    def normalize(self, path):
+        return '/'
+
+    def cwd(self, path):
+        self.sftp_client.cwd = posixpath.join(self.sftp_client.cwd, path)
+
+
+TREE = {
+    'media': {
+        'top.txt': 1,
+        'show': {'s1': {'e1.mkv': 10, 'e2.mkv': 20}, 's2': {'e1.mkv': 100}},
+        'empty': {},
+    }
+}
+
+LIST_CONFIG = {
+    'host': 'example.com',
+    'port': 22,
+    'username': 'user',
+    'files_only': True,
+    'recursive': False,
+    'get_size': True,
+    'dirs': ['media'],
+    'backend': 'pysftp',
+    'cache': False,
+    'cache_ttl': 3600,
+}
+
+
+def sftp_list(connection, **options):
+    """Run sftp_list over a fake connection, returning the entries"""
+    config = dict(LIST_CONFIG, **options)
+    with mock.patch.object(sftp, 'dependency_check'), mock.patch.object(
+        sftp, 'pool_acquire', return_value=connection
+    ), mock.patch.object(sftp, 'pool_release'):
+        return sftp.SftpList().on_task_input(None, config)
+
+
+class TestSftpList:
+    def test_returns_list(self):
+        entries = sftp_list(FakeSftp(TREE))
+
+        assert isinstance(entries, list)
+        assert [entry['url'] for entry in entries] == ['sftp://user@example.com/media/top.txt']
+
+    @mock.patch.object(sftp, 'pool_acquire', side_effect=OSError('Connection refused'))
+    @mock.patch.object(sftp, 'dependency_check')
+    def test_connection_failure(self, dependency_check, pool_acquire):
+        # raised by the call itself, so that other inputs still run
+        with pytest.raises(plugin.PluginError):
+            sftp.SftpList().on_task_input(None, dict(LIST_CONFIG))
+
+    def test_recursive_sizes(self):
+        connection = FakeSftp(TREE)
+        entries = sftp_list(connection, recursive=True, files_only=False)
+
+        # directories come after their contents, with the size of their whole subtree
+        assert [(entry['url'], entry['content_size']) for entry in entries] == [
+            ('sftp://user@example.com/media/top.txt', 1),
+            ('sftp://user@example.com/media/empty', 0),
+            ('sftp://user@example.com/media/show/s1/e1.mkv', 10),
+            ('sftp://user@example.com/media/show/s1/e2.mkv', 20),
+            ('sftp://user@example.com/media/show/s1', 30),
+            ('sftp://user@example.com/media/show/s2/e1.mkv', 100),
+            ('sftp://user@example.com/media/show/s2', 100),
+            ('sftp://user@example.com/media/show', 130),
+        ]
+        # every directory is listed exactly once
+        assert sorted(connection.sftp_client.listed) == [
+            'media',
+            'media/empty',
+            'media/show',
+            'media/show/s1',
+            'media/show/s2',
+        ]
+
+    def test_recursive_files_only(self):
+        entries = sftp_list(FakeSftp(TREE), recursive=True)
+
+        assert [entry['title'] for entry in entries] == ['top.txt', 'e1.mkv', 'e2.mkv', 'e1.mkv']
+
+    def test_non_recursive_sizes(self):
+        entries = sftp_list(FakeSftp(TREE), files_only=False)
+
+        assert [(entry['title'], entry['content_size']) for entry in entries] == [
+            ('top.txt', 1),
+            ('empty', 0),
+            ('show', 130),
+        ]
+
+    @mock.patch.object(sftp, 'paramiko')
+    def test_parallel_sizes(self, paramiko):
+        # enough directories for their sizes to be computed over extra channels
+        tree = {'wide': {'d%d' % i: {'f': i, 'sub': {'g': 10}} for i in range(6)}}
+        paramiko.SFTPClient.from_transport.side_effect = lambda transport: FakeClient(tree)
+        entries = sftp_list(FakeSftp(tree), files_only=False, dirs=['wide'])
+
+        # no more channels than directories
+        assert paramiko.SFTPClient.from_transport.call_count == 6
+        assert [(entry['title'], entry['content_size']) for entry in entries] == [
+            ('d%d' % i, i + 10) for i in range(6)
+        ]
+
+    def test_no_size(self):
+        entries = sftp_list(FakeSftp(TREE), recursive=True, files_only=False, get_size=False)
+
+        assert len(entries) == 8
+        assert not any('content_size' in entry for entry in entries)
+
+
+class FakeAsyncSftp:
+    """Stands in for an asyncssh SFTPClient serving the same trees as FakeClient"""
+
+    def __init__(self, tree):
+        self.client = FakeClient(tree)
+
+    async def readdir(self, path):
+        try:
+            listing = self.client.listdir_attr(path)
+        except IOError as e:
+            raise sftp.asyncssh.SFTPError(sftp.asyncssh.FX_PERMISSION_DENIED, str(e))
+        return [
+            SimpleNamespace(
+                filename=attr.filename,
+                attrs=SimpleNamespace(permissions=attr.st_mode, size=attr.st_size),
+            )
+            for attr in listing
+        ]
+
+    async def realpath(self, path):
+        return '/'
+
+    async def stat(self, path):
+        attr = self.client.stat(path)
+        return SimpleNamespace(permissions=attr.st_mode, size=attr.st_size)
+
+    async def get(self, path, destination, max_requests=None):
+        with open(destination, 'wb') as local_file:
+            local_file.write(b'x' * self.client.lookup(path))
+
+
+class FakeAsyncConnection:
+    """Stands in for an asyncssh SSHClientConnection to a host serving tree"""
+
+    def __init__(self, tree):
+        self.sftp = FakeAsyncSftp(tree)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def start_sftp_client(self):
+        return self
+
+    def __getattr__(self, name):
+        # the connection is also used as the SFTP client it starts
+        return getattr(self.sftp, name)
+
+
+class TestAsyncsshWalk:
+    def walk(self, remote, **options):
+        options = {'recursive': False, 'get_size': True, 'files_only': True, **options}
+
+        async def walk():
+            semaphore = asyncio.Semaphore(1)
+            return await sftp.asyncssh_walk(remote, 'media', semaphore=semaphore, **options)
+
+        return sftp.asyncssh_run(walk())
+
+    def test_files_only_skips_size_walk(self):
+        remote = FakeAsyncSftp(TREE)
+        nodes, _ = self.walk(remote)
+
+        assert remote.client.listed == ['media']
+        assert ('media/top.txt', 1, False) in nodes
+
+    def test_directory_sizes(self):
+        remote = FakeAsyncSftp(TREE)
+        nodes, total = self.walk(remote, files_only=False)
+
+        assert ('media/show', 130, True) in nodes
+        assert total == 131
+        assert sorted(remote.client.listed) == [
+            'media',
+            'media/empty',
+            'media/show',
+            'media/show/s1',
+            'media/show/s2',
+        ]
+
+    @pytest.mark.skipif(sftp.asyncssh is None, reason='asyncssh module required')
+    def test_unreadable_subdirectory(self):
+        remote = FakeAsyncSftp(TREE)
+        remote.client.denied.add('media/show')
+        nodes, total = self.walk(remote, files_only=False)
+
+        assert nodes == [
+            ('media/top.txt', 1, False),
+            ('media/empty', 0, True),
+            ('media/show', -1, True),
+        ]
+        assert total == -1
+
+    @pytest.mark.skipif(sftp.asyncssh is None, reason='asyncssh module required')
+    def test_backends_list_the_same_entries(self):
+        pysftp_connection = FakeSftp(TREE)
+        pysftp_connection.sftp_client.denied.add('media/show')
+        connection = FakeAsyncConnection(TREE)
+        connection.sftp.client.denied.add('media/show')
+
+        with mock.patch.object(sftp, 'asyncssh_connect', return_value=connection):
+            entries = sftp_list(None, files_only=False, backend='asyncssh')
+
+        expected = sftp_list(pysftp_connection, files_only=False)
+        assert [(e['title'], e['content_size']) for e in entries] == [
+            ('top.txt', 1),
+            ('empty', 0),
+            ('show', -1),
+        ]
+        assert [(e['title'], e['content_size']) for e in entries] == [
+            (e['title'], e['content_size']) for e in expected
+        ]
+
+
+class TestSftpListCache:
+    config = 'tasks: {}'
+
+    # a plain Mock, since asyncssh_run never awaits the coroutine an AsyncMock would return
+    @mock.patch.object(sftp, 'asyncssh_list', new_callable=mock.Mock)
+    @mock.patch.object(sftp, 'asyncssh_run', return_value=('/', []))
+    @mock.patch.object(sftp, 'dependency_check')
+    def test_asyncssh_warns(self, dependency_check, asyncssh_run, asyncssh_list, caplog):
+        config = dict(LIST_CONFIG, backend='asyncssh', cache=True)
+        assert sftp.SftpList().on_task_input(None, config) == []
+
+        assert 'does not support the cache' in caplog.text
+
+    def test_reuses_unmodified_listings(self, manager):
+        connection = FakeSftp(TREE)
+        first = sftp_list(connection, recursive=True, files_only=False, cache=True)
+        assert connection.sftp_client.listed
+
+        connection.sftp_client.listed = []
+        second = sftp_list(connection, recursive=True, files_only=False, cache=True)
+
+        assert not connection.sftp_client.listed
+        assert [(e['url'], e['content_size']) for e in second] == [
+            (e['url'], e['content_size']) for e in first
+        ]
+
+    def test_listings_are_per_user(self, manager):
+        connection = FakeSftp(TREE)
+        sftp_list(connection, cache=True)
+
+        connection.sftp_client.listed = []
+        sftp_list(connection, cache=True, username='other')
+
+        assert connection.sftp_client.listed == ['media']
+
+    def test_relists_only_modified_directories(self, manager):
+        tree = copy.deepcopy(TREE)
+        connection = FakeSftp(tree)
+        sftp_list(connection, recursive=True, files_only=False, cache=True)
+
+        # a new file at the top only changes the modification time of the top directory
+        tree['media']['new.txt'] = 5
+        client = connection.sftp_client
+        stat_node = client.stat
+        client.stat = lambda path: (
+            attributes(DIR, mtime=1) if path == 'media' else stat_node(path)
+        )
+        client.listed = []
+        entries = sftp_list(connection, recursive=True, files_only=False, cache=True)
+
+        assert client.listed == ['media']
+        sizes = {entry['title']: entry['content_size'] for entry in entries}
+        assert sizes['new.txt'] == 5
+        assert sizes['show'] == 130
+
+
+class TestListingCacheDb:
+    config = 'tasks: {}'
+
+    def store(self, path, mtime, nodes, username='user'):
+        with Session() as session:
+            db.store_listing(
+                session, 'example.com', 22, username, path, attributes(DIR, mtime=mtime), nodes
+            )
+
+    def get(self, path, mtime, ttl=3600, host='example.com', username='user'):
+        with Session() as session:
+            return db.get_listing(session, host, 22, username, path, mtime, ttl)
+
+    def test_get_listing(self, manager):
+        self.store('/media', 1, [('/media/a.mkv', attributes(FILE, 10, 2))])
+
+        assert self.get('/media', 1) == [('/media/a.mkv', db.CachedAttributes(10, FILE, 2))]
+        assert self.get('/media', 1, host='other.com') is None
+        assert self.get('/media', 1, username='other') is None
+        assert self.get('/other', 1) is None
+
+    def test_mtime_mismatch(self, manager):
+        self.store('/media', 1, [('/media/a.mkv', attributes(FILE, 10))])
+
+        assert self.get('/media', 2) is None
+
+    def test_ttl_expired(self, manager):
+        self.store('/media', 1, [('/media/a.mkv', attributes(FILE, 10))])
+        with Session() as session:
+            directory = session.query(db.SftpListCache).filter_by(path='/media').one()
+            directory.listed -= timedelta(hours=2)
+
+        assert self.get('/media', 1, ttl=3600) is None
+        assert self.get('/media', 1, ttl=3 * 3600) is not None
+
+    def test_relisting_parent_keeps_subdirectory(self, manager):
+        self.store('/media', 1, [('/media/show', attributes(DIR, mtime=2))])
+        self.store('/media/show', 2, [('/media/show/e1.mkv', attributes(FILE, 10))])
+
+        self.store(
+            '/media',
+            3,
+            [('/media/a.mkv', attributes(FILE, 5)), ('/media/show', attributes(DIR, mtime=2))],
+        )
+
+        assert self.get('/media/show', 2) == [
+            ('/media/show/e1.mkv', db.CachedAttributes(10, FILE, 0))
+        ]
+        assert self.get('/media', 3) == [
+            ('/media/a.mkv', db.CachedAttributes(5, FILE, 0)),
+            ('/media/show', db.CachedAttributes(0, DIR, 2)),
+        ]
+
+    def test_relisting_parent_keeps_modified_subdirectory_stale(self, manager):
+        self.store('/media', 1, [('/media/show', attributes(DIR, mtime=2))])
+        self.store('/media/show', 2, [('/media/show/e1.mkv', attributes(FILE, 10))])
+
+        self.store('/media', 3, [('/media/show', attributes(DIR, mtime=4))])
+
+        assert self.get('/media/show', 4) is None
+
+    def test_relisting_parent_drops_removed_subdirectory(self, manager):
+        self.store('/media', 1, [('/media/show', attributes(DIR, mtime=2))])
+        self.store('/media/show', 2, [('/media/show/s1', attributes(DIR, mtime=3))])
+        self.store('/media/show/s1', 3, [('/media/show/s1/e1.mkv', attributes(FILE, 10))])
+
+        self.store('/media', 4, [])
+
+        with Session() as session:
+            paths = {node.path for node in session.query(db.SftpListCache)}
+        assert paths == {'/media'}
+
+    def test_db_cleanup_keeps_used_listings(self, manager):
+        self.store('/media', 1, [('/media/a.mkv', attributes(FILE, 10))])
+        with Session() as session:
+            session.query(db.SftpListCache).update(
+                {'last_seen': datetime.now() - timedelta(days=8)}, synchronize_session=False
+            )
+
+        # still valid with a long cache_ttl, which counts as seeing its nodes
+        assert self.get('/media', 1, ttl=30 * 24 * 3600) is not None
+        manager.db_cleanup(force=True)
+
+        assert self.get('/media', 1, ttl=30 * 24 * 3600) == [
+            ('/media/a.mkv', db.CachedAttributes(10, FILE, 0))
+        ]
+
+    def test_db_cleanup(self, manager):
+        self.store('/old', 1, [('/old/a.mkv', attributes(FILE, 10))])
+        self.store('/new', 1, [('/new/a.mkv', attributes(FILE, 10))])
+        with Session() as session:
+            old = session.query(db.SftpListCache).filter(db.SftpListCache.path.like('/old%'))
+            old.update(
+                {'last_seen': datetime.now() - timedelta(days=8)}, synchronize_session=False
+            )
+
+        manager.db_cleanup(force=True)
+
+        with Session() as session:
+            paths = {node.path for node in session.query(db.SftpListCache)}
+        assert paths == {'/new', '/new/a.mkv'}
+
+
+class TestSftpGet:
+    def connection(self, remote_file):
+        connection = mock.MagicMock()
+        connection.sftp_client.open.return_value.__enter__.return_value = remote_file
+        return connection
+
+    @pytest.mark.parametrize('bounded', [True, False])
+    def test_prefetch(self, tmpdir, bounded):
+        remote_file = mock.Mock()
+        remote_file.read.side_effect = [b'data', b'']
+        destination = tmpdir.join('file')
+
+        with mock.patch.object(sftp, 'BOUNDED_PREFETCH', bounded):
+            sftp.sftp_get(self.connection(remote_file), 'file', str(destination), 16, size=4)
+
+        if bounded:
+            remote_file.prefetch.assert_called_once_with(4, 16)
+        else:
+            remote_file.prefetch.assert_called_once_with(4)
+        assert destination.read_binary() == b'data'
+
+
+class TestSftpUpload:
+    config = {
+        'host': 'example.com',
+        'port': 22,
+        'username': 'user',
+        'password': None,
+        'to': '/uploads',
+        'delete_origin': False,
+        'confirm': True,
+    }
+
+    def upload(self, tmpdir, error=None):
+        location = tmpdir.join('file.mkv')
+        location.write('data')
+        entry = Entry('file', 'file://' + str(location), location=str(location))
+        connection = mock.Mock()
+        connection.put.side_effect = error
+
+        reason = sftp.SftpUpload().handle_entry(
+            entry, connection, '/uploads', self.config, 'sftp://user@example.com/', {}
+        )
+
+        connection.put.assert_called_once_with(
+            localpath=str(location), remotepath='/uploads/file.mkv', confirm=True
+        )
+        # entries are failed by the caller, from the task's thread
+        assert not entry.failed
+        return reason
+
+    def test_upload(self, tmpdir):
+        assert self.upload(tmpdir) is None
+
+    def test_missing_directory(self, tmpdir):
+        reason = self.upload(tmpdir, IOError(errno.ENOENT, 'No such file'))
+
+        assert reason.startswith('Remote directory does not exist')
+
+    def test_size_mismatch(self, tmpdir):
+        reason = self.upload(tmpdir, IOError('size mismatch in put!  2 != 4'))
+
+        assert reason.startswith('Failed to upload')
+
+    @mock.patch.object(sftp, 'pool_release')
+    @mock.patch.object(sftp, 'pool_acquire')
+    def test_connections(self, pool_acquire, pool_release, tmpdir):
+        task = mock.Mock()
+        config = dict(self.config, concurrency=4)
+        location = tmpdir.join('file.mkv')
+        location.write('data')
+
+        task.accepted = []
+        sftp.SftpUpload().on_task_output(task, dict(config))
+        assert not pool_acquire.called
+
+        task.accepted = [Entry('file', 'file://' + str(location), location=str(location))]
+        sftp.SftpUpload().on_task_output(task, dict(config))
+        assert pool_acquire.call_count == 1
+        assert pool_release.call_count == 1
+        assert not task.accepted[0].failed
+
+    @mock.patch.object(sftp, 'pool_release')
+    @mock.patch.object(sftp, 'pool_acquire')
+    def test_fails_entries_in_task_thread(self, pool_acquire, pool_release, tmpdir):
+        task = mock.Mock()
+        task.accepted = [
+            Entry('file%d' % i, 'file://' + str(tmpdir.join('file%d' % i)), location=str(tmpdir))
+            for i in range(2)
+        ]
+        failed_in = []
+
+        def fail(entry, reason):
+            failed_in.append(threading.current_thread())
+
+        upload = sftp.SftpUpload()
+        with mock.patch.object(upload, 'handle_entry', return_value='Failed'), mock.patch.object(
+            Entry, 'fail', autospec=True, side_effect=fail
+        ):
+            upload.on_task_output(task, dict(self.config, concurrency=2))
+
+        assert pool_acquire.call_count == 2
+        assert failed_in == [threading.current_thread()] * 2
+
+
+@mock.patch.object(sftp, 'pool_release')
+@mock.patch.object(sftp, 'pool_acquire', side_effect=lambda conf: FakeSftp(TREE))
+@mock.patch.object(sftp, 'dependency_check')
+class TestSftpDownload:
+    config = {
+        'recursive': True,
+        'delete_origin': False,
+        'concurrency': 4,
+        'max_unconfirmed_reads': 64,
+        'backend': 'pysftp',
+    }
+
+    def download(self, tmpdir, *paths):
+        task = mock.Mock()
+        task.accepted = [
+            Entry(posixpath.basename(path), 'sftp://user@example.com' + path) for path in paths
+        ]
+        config = dict(self.config, to=str(tmpdir))
+        sftp.SftpDownload().on_task_download(task, config)
+        return task.accepted
+
+    def test_file(self, dependency_check, pool_acquire, pool_release, tmpdir):
+        entries = self.download(tmpdir, '/media/top.txt', '/media/show/s2/e1.mkv')
+
+        assert not any(entry.failed for entry in entries)
+        assert tmpdir.join('top.txt').size() == 1
+        assert tmpdir.join('e1.mkv').size() == 100
+        # files only ever use the first connection
+        assert pool_acquire.call_count == 1
+        assert pool_release.call_count == 1
+
+    def test_directory(self, dependency_check, pool_acquire, pool_release, tmpdir):
+        entries = self.download(tmpdir, '/media/show/s1')
+
+        assert not any(entry.failed for entry in entries)
+        assert tmpdir.join('s1', 'e1.mkv').size() == 10
+        assert tmpdir.join('s1', 'e2.mkv').size() == 20
+        # one connection per file at most
+        assert pool_acquire.call_count == 2
+        assert pool_release.call_count == 2
+
+    def test_releases_on_error(self, dependency_check, pool_acquire, pool_release, tmpdir):
+        connection = FakeSftp(TREE)
+        connection.sftp_client.stat = mock.Mock(side_effect=EOFError)
+        pool_acquire.side_effect = None
+        pool_acquire.return_value = connection
+
+        with pytest.raises(EOFError):
+            self.download(tmpdir, '/media/top.txt')
+
+        pool_release.assert_called_once_with(mock.ANY, connection)
+
+
+@mock.patch.object(sftp, 'dependency_check')
+class TestSftpDownloadAsyncssh:
+    config = dict(TestSftpDownload.config, backend='asyncssh')
+
+    def download(self, tmpdir, *paths, denied=()):
+        task = mock.Mock()
+        task.accepted = [
+            Entry(posixpath.basename(path), 'sftp://user@example.com' + path) for path in paths
+        ]
+        self.connections = []
+
+        async def connect(conf):
+            self.connections.append(FakeAsyncConnection(TREE))
+            self.connections[-1].sftp.client.denied.update(denied)
+            return self.connections[-1]
+
+        with mock.patch.object(sftp, 'asyncssh_connect', new=connect):
+            sftp.SftpDownload().on_task_download(task, dict(self.config, to=str(tmpdir)))
+        return task.accepted
+
+    def test_file(self, dependency_check, tmpdir):
+        entries = self.download(tmpdir, '/media/top.txt', '/media/show/s2/e1.mkv')
+
+        assert not any(entry.failed for entry in entries)
+        assert tmpdir.join('top.txt').size() == 1
+        assert tmpdir.join('e1.mkv').size() == 100
+        # entries for the same host share a connection
+        assert len(self.connections) == 1
+
+    def test_directory(self, dependency_check, tmpdir):
+        entries = self.download(tmpdir, '/media/show')
+
+        assert not any(entry.failed for entry in entries)
+        assert tmpdir.join('show', 's1', 'e1.mkv').size() == 10
+        assert tmpdir.join('show', 's1', 'e2.mkv').size() == 20
+        assert tmpdir.join('show', 's2', 'e1.mkv').size() == 100
+
+    @pytest.mark.skipif(sftp.asyncssh is None, reason='asyncssh module required')
+    def test_unreadable_subdirectory(self, dependency_check, tmpdir):
+        entries = self.download(tmpdir, '/media/show', denied={'/media/show/s2'})
+
+        assert entries[0].failed
+        assert not tmpdir.join('show').check()
+
+
+class TestLocalDestination:
+    def test_destination(self, tmpdir):
+        known_dirs = set()
+        destination = sftp.local_destination('/show/s1/e1.mkv', str(tmpdir), known_dirs)
+
+        assert destination == str(tmpdir.join('show', 's1', 'e1.mkv'))
+        assert tmpdir.join('show', 's1').isdir()
+        assert known_dirs == {str(tmpdir.join('show', 's1'))}
+
+    def test_existing(self, tmpdir):
+        tmpdir.join('e1.mkv').write('data')
+
+        assert sftp.local_destination('e1.mkv', str(tmpdir), set()) is None
+
+    def test_remove_partial(self, tmpdir):
+        destination = tmpdir.join('e1.mkv')
+
+        with pytest.raises(EOFError):
+            with sftp.remove_partial('e1.mkv', str(destination)):
+                destination.write('partial')
+                raise EOFError
+
+        assert not destination.exists()
+
+
+class TestConnectionPool:
+    @pytest.fixture(autouse=True)
+    def pool(self):
+        with mock.patch.dict(sftp._pool, clear=True), mock.patch.object(
+            sftp, '_schedule_eviction'
+        ), mock.patch.object(sftp, '_pool_timer', None), mock.patch.object(
+            sftp, 'sftp_connect'
+        ) as sftp_connect:
+            yield sftp_connect
+
+    def test_connects(self, pool):
+        conf = mock.Mock(host='example.com')
+
+        assert sftp.pool_acquire(conf) is pool.return_value
+        pool.assert_called_once_with(conf)
+
+    def test_reuses_live_connection(self, pool):
+        conf = mock.Mock(host='example.com')
+        connection = mock.Mock()
+        sftp.pool_release(conf, connection)
+
+        assert sftp.pool_acquire(conf) is connection
+        connection.chdir.assert_called_once_with(None)
+        assert not pool.called
+        assert not sftp._pool[conf]
+
+    @pytest.mark.skipif(sftp.paramiko is None, reason='paramiko module required')
+    def test_discards_dead_connection(self, pool):
+        conf = mock.Mock(host='example.com')
+        dead = mock.Mock()
+        dead.normalize.side_effect = EOFError
+        sftp.pool_release(conf, dead)
+
+        assert sftp.pool_acquire(conf) is pool.return_value
+        assert dead.close.called
+
+    def test_evicts_idle_connections(self):
+        conf = mock.Mock(host='example.com')
+        old, new = mock.Mock(), mock.Mock()
+        sftp.pool_release(conf, old)
+        sftp.pool_release(conf, new)
+        sftp._pool[conf][0] = (old, sftp._pool[conf][0][1] - sftp.POOL_IDLE_TIMEOUT - 1)
+
+        sftp._evict_idle()
+
+        assert old.close.called
+        assert not new.close.called
+        assert [connection for connection, _ in sftp._pool[conf]] == [new]
+
+
+class TestPoolMap:
+    conf = sftp.ConnectionConfig('example.com', 22, 'user', None, None, None)
+
+    @mock.patch.object(sftp, 'pool_release')
+    @mock.patch.object(sftp, 'pool_acquire')
+    def test_single_connection_runs_inline(self, pool_acquire, pool_release):
+        def func(connection, item):
+            return item, threading.current_thread()
+
+        results = sftp.pool_map(self.conf, func, [1, 2], 1)
+
+        assert results == [(1, threading.current_thread()), (2, threading.current_thread())]
+        pool_release.assert_called_once_with(self.conf, pool_acquire.return_value)
+
+    @mock.patch.object(sftp, 'pool_release')
+    @mock.patch.object(sftp, 'pool_acquire')
+    def test_failed_prepare_releases_connection(self, pool_acquire, pool_release):
+        first, broken = mock.Mock(), mock.Mock()
+        pool_acquire.side_effect = [first, broken]
+
+        def prepare(connection):
+            if connection is broken:
+                raise IOError(errno.ENOENT, 'No such file')
+
+        used = sftp.pool_map(
+            self.conf, lambda connection, item: connection, [1, 2], 2, prepare=prepare
+        )
+
+        # the remaining items only use the connection which was set up
+        assert used == [first, first]
+        assert pool_release.call_args_list == [
+            mock.call(self.conf, broken),
+            mock.call(self.conf, first),
+        ]
+
+
+class TestCompilePath:
+    config = 'tasks: {}'
+
+    def test_literal(self, manager):
+        assert sftp.compile_path('/media/{{ "tv" }}') == '/media/tv'
+
+    def test_template(self, manager):
+        template = sftp.compile_path('/media/{{ series_name }}')
+
+        assert isinstance(template, Template)
+        entry = Entry(title='a', url='http://a', series_name='Show')
+        assert render_from_entry(template, entry) == '/media/Show'
+
+    def test_syntax_error(self, manager):
+        with pytest.raises(plugin.PluginError):
+            sftp.compile_path('/media/{{')
+
+    def test_empty(self, manager):
+        assert sftp.compile_path(None) is None
+
+
+class TestQuotePath:
+    @pytest.mark.parametrize(
+        'path, quoted',
+        [
+            ('/a b/c#d', '/a%20b/c%23d'),
+            ('relative/path.mkv', 'relative/path.mkv'),
+            ('/dir/', '/dir/'),
+            ('/100%/ä', '/100%25/%C3%A4'),
+        ],
+    )
+    def test_quote_path(self, path, quoted):
+        assert sftp.quote_path(path) == quoted
+
+
+class TestRemoveDir:
+    @pytest.mark.parametrize(
+        'error, level',
+        [
+            (None, None),
+            (IOError(errno.ENOTEMPTY, 'Directory not empty'), 'debug'),
+            (IOError(errno.ENOENT, 'No such file'), 'debug'),
+            (IOError('Failure'), 'debug'),
+            (IOError(errno.EACCES, 'Permission denied'), 'error'),
+            (EOFError(), 'error'),
+        ],
+    )
+    @mock.patch.object(sftp, 'logger')
+    def test_remove_dir(self, logger, error, level):
+        connection = mock.Mock()
+        connection.rmdir.side_effect = error
+        sftp.SftpDownload().remove_dir(connection, '/media/show')
+
+        connection.rmdir.assert_called_once_with('/media/show')
+        # the attempt itself is always logged at debug level
+        assert logger.debug.call_count == (2 if level == 'debug' else 1)
+        assert logger.error.called == (level == 'error')